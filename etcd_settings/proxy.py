@@ -1,12 +1,58 @@
 import os
 import re
+import time
 from importlib import import_module
 
 from django.conf import settings as django_settings
+from etcd import (
+    EtcdEventIndexCleared, EtcdException, EtcdKeyNotFound, EtcdWatchTimedOut,
+)
 from etcd_config.manager import EtcdConfigManager
-from etcd_config.utils import attrs_to_dir
+from etcd_config.utils import attrs_to_dir, threaded
 
-from .utils import copy_if_mutable, dict_rec_update, find_project_root
+from .rules import ConfigSetMatcher
+from .utils import (
+    Backoff, CircuitBreaker, copy_if_mutable, dict_rec_update,
+    find_project_root,
+)
+
+
+class _EtcdConfigStore(object):
+    """
+    Reads and watches etcd for the proxy. The monitors of EtcdConfigManager
+    are deliberately not used any more, since they retry with a fixed delay
+    and cannot resume from a given index, so the proxy runs its own loops on
+    top of internals of the manager. All access to those internals is kept
+    in this class.
+    """
+
+    def __init__(self, mgr, env):
+        self._mgr = mgr
+        self.logger = mgr.logger
+        self.env_defaults_path = mgr._env_defaults_path(env)
+        self.config_sets_path = mgr._base_config_set_path
+        self.rules_path = "{}/selection/rules".format(mgr._base_config_path)
+        self.paths = (
+            self.env_defaults_path, self.config_sets_path, self.rules_path)
+
+    def read(self, path, timeout=None):
+        return self._mgr._client.read(path, recursive=True, timeout=timeout)
+
+    def watch(self, path, index):
+        return self._mgr._client.watch(
+            path, index=index, recursive=True,
+            timeout=self._mgr.long_polling_timeout)
+
+    def env_defaults(self, res):
+        conf = self._mgr._process_response_set(res)
+        conf.update(EtcdConfigManager.get_dev_params(self._mgr._dev_params))
+        return conf
+
+    def config_sets(self, res):
+        return self._mgr._process_response_set(res, env_defaults=False)
+
+    def decode_value(self, value):
+        return self._mgr._decode_config_value(value)
 
 
 class EtcdSettingsProxy(object):
@@ -19,15 +65,86 @@ class EtcdSettingsProxy(object):
             getattr(django_settings, 'DJES_REQUEST_GETTER', None))
         self._locate_wsgi_file(
             getattr(django_settings, 'DJES_WSGI_FILE', None))
+        self._init_reconnect_policy(
+            getattr(django_settings, 'DJES_RECONNECT_POLICY', None))
+        self._synced = {}
+        self._indexes = {}
+        self._rules = ConfigSetMatcher()
         if etcd_details is not None:
             self._etcd_mgr = EtcdConfigManager(dev_params, **etcd_details)
-            self._config_sets = self._etcd_mgr.get_config_sets()
-            self._env_defaults = self._etcd_mgr.get_env_defaults(self.env)
+            self._store = _EtcdConfigStore(self._etcd_mgr, self.env)
+            self._load_snapshot(dev_params)
         else:
             self._etcd_mgr = None
+            self._store = None
             self._config_sets = dict()
             self._env_defaults = EtcdConfigManager.get_dev_params(dev_params)
 
+    def _init_reconnect_policy(self, policy):
+        policy = policy or {}
+        self._backoff_base = policy.get('backoff_base', 0.5)
+        self._backoff_cap = policy.get('backoff_cap', 60)
+        self._startup_timeout = policy.get('startup_timeout', 5)
+        self._breaker = CircuitBreaker(
+            failure_threshold=policy.get('failure_threshold', 5),
+            reset_timeout=policy.get('reset_timeout', 30))
+
+    def _load_snapshot(self, dev_params):
+        try:
+            res = self._initial_read(self._store.config_sets_path)
+            config_sets = {}
+            if res is not None:
+                config_sets = self._store.config_sets(res)
+            res = self._initial_read(self._store.env_defaults_path)
+            env_defaults = EtcdConfigManager.get_dev_params(dev_params)
+            if res is not None:
+                env_defaults = self._store.env_defaults(res)
+            res = self._initial_read(self._store.rules_path)
+            if res is not None:
+                self._update_rules(res)
+        except EtcdException as e:
+            # Unreachable, slow or unhealthy (5xx, leader election...): start
+            # from local settings, the monitors will resync once etcd is
+            # healthy again
+            self._store.logger.warning(
+                "etcd unavailable, serving local settings: {}".format(e))
+            self._breaker.record_failure()
+            self._indexes = {}
+            self._config_sets = dict()
+            self._env_defaults = EtcdConfigManager.get_dev_params(dev_params)
+        else:
+            self._config_sets = config_sets
+            self._env_defaults = env_defaults
+            now = time.time()
+            for path in self._store.paths:
+                self._synced[path] = now
+
+    def _initial_read(self, path):
+        """
+        Full read of `path` at startup, bounded by the startup timeout so that
+        a slow etcd cannot stall the process. Returns None if `path` does not
+        exist yet, the monitors will pick it up once it is created.
+        """
+        try:
+            res = self._store.read(path, timeout=self._startup_timeout)
+        except EtcdKeyNotFound as e:
+            self._store.logger.warning("Unable to find '{}'".format(path))
+            self._indexes[path] = e.payload['index'] + 1
+            return None
+        self._indexes[path] = res.etcd_index + 1
+        return res
+
+    def _update_rules(self, res):
+        try:
+            rules = []
+            if res.value is not None:
+                rules = self._store.decode_value(res.value)
+            self._rules = ConfigSetMatcher(rules)
+        except ValueError as e:
+            # Keep selecting config sets with the previous rules
+            self._store.logger.error(
+                "Invalid config set rules at '{}': {}".format(res.key, e))
+
     def _locate_wsgi_file(self, wsgi_file):
         if wsgi_file is None:
             self._wsgi_file = None
@@ -54,15 +171,140 @@ class EtcdSettingsProxy(object):
         if self._req_getter is not None:
             request = self._req_getter()
             if request and getattr(request, "META", None):
-                sets = request.META.get('HTTP_X_DYNAMIC_SETTING', '').split()
+                # Cached per request, invalidated when the rules change
+                cached = getattr(request, '_etcd_settings_config_sets', None)
+                if cached is not None and cached[0] is self._rules:
+                    return cached[1]
+                rules = self._rules
+                if rules:
+                    sets = rules.match(request)
+                sets += request.META.get('HTTP_X_DYNAMIC_SETTING', '').split()
+                request._etcd_settings_config_sets = (rules, sets)
         return sets
 
+    @property
+    def snapshot_age(self):
+        """
+        Seconds since all of the settings were last known to match etcd, None
+        if some of them were never read from it
+        """
+        if self._store is None:
+            return None
+        synced = [self._synced.get(path) for path in self._store.paths]
+        if None in synced:
+            return None
+        return time.time() - min(synced)
+
+    @property
+    def degraded(self):
+        """True while the settings are served from a possibly stale snapshot"""
+        return self._store is not None and (
+            self.snapshot_age is None
+            or self._breaker.state != CircuitBreaker.CLOSED)
+
     def start_monitors(self):
-        if self._etcd_mgr is not None:
-            self._etcd_mgr.monitor_env_defaults(
-                env=self.env, conf=self._env_defaults,
-                wsgi_file=self._wsgi_file)
-            self._etcd_mgr.monitor_config_sets(conf=self._config_sets)
+        if self._store is not None:
+            self.monitor_env_defaults()
+            self.monitor_config_sets()
+            self.monitor_rules()
+
+    @threaded(daemon=True)
+    def monitor_env_defaults(self, max_events=None):
+        processed_events = 0
+        path = self._store.env_defaults_path
+        for event in self._watch(path, max_events):
+            if event is not None:
+                self._env_defaults.update(self._store.env_defaults(event))
+                if self._wsgi_file:
+                    with open(self._wsgi_file, 'a'):
+                        os.utime(self._wsgi_file, None)
+            processed_events += 1
+        return processed_events
+
+    @threaded(daemon=True)
+    def monitor_config_sets(self, max_events=None):
+        processed_events = 0
+        path = self._store.config_sets_path
+        for event in self._watch(path, max_events):
+            if event is not None:
+                self._config_sets.update(self._store.config_sets(event))
+            processed_events += 1
+        return processed_events
+
+    @threaded(daemon=True)
+    def monitor_rules(self, max_events=None):
+        processed_events = 0
+        for event in self._watch(self._store.rules_path, max_events):
+            if event is not None:
+                self._update_rules(event)
+            processed_events += 1
+        return processed_events
+
+    def _watch(self, path, max_events=None):
+        """
+        Long poll `path`, resuming from the last applied index. Failures are
+        retried with jittered exponential backoff, and no request is sent at
+        all while the circuit breaker is open, except for a single probe once
+        it half-opens.
+        """
+        backoff = Backoff(self._backoff_base, self._backoff_cap)
+        i = 0
+        while (max_events is None) or (i < max_events):
+            i += 1
+            while not self._breaker.allow_request():
+                time.sleep(self._breaker.retry_after())
+            index = self._indexes.get(path)
+            res = None
+            try:
+                if index is None:
+                    res = self._store.read(path)
+                    self._indexes[path] = res.etcd_index + 1
+                else:
+                    try:
+                        res = self._store.watch(path, index)
+                        self._indexes[path] = res.modifiedIndex + 1
+                    except EtcdWatchTimedOut:
+                        self._confirm_watch_timeout(path, index)
+            except EtcdEventIndexCleared:
+                # Too many events were missed, fall back to a full read
+                self._indexes[path] = None
+                self._breaker.record_success()
+                backoff.reset()
+                yield None
+                continue
+            except EtcdKeyNotFound as e:
+                # Wait for the key to be created
+                self._indexes[path] = e.payload['index'] + 1
+            except Exception as e:
+                self._breaker.record_failure()
+                delay = backoff.next_delay()
+                self._store.logger.error(
+                    "Long Polling Error: {}, retrying in {:.1f}s".format(
+                        e, delay))
+                time.sleep(delay)
+                yield None
+                continue
+            self._breaker.record_success()
+            backoff.reset()
+            self._synced[path] = time.time()
+            yield res
+
+    def _confirm_watch_timeout(self, path, index):
+        """
+        python-etcd raises EtcdWatchTimedOut as well for a server accepting
+        the connection but never answering, so check with a bounded read that
+        etcd is still responsive. Any error raised here is a failure of the
+        watch. If nothing under `path` changed since `index`, the watch moves
+        on to the current index so that it does not fall out of the event
+        history of etcd.
+        """
+        try:
+            res = self._store.read(path, timeout=self._startup_timeout)
+        except EtcdKeyNotFound:
+            # Keep the index, the next watch returns the deletion
+            return
+        if max(node.modifiedIndex for node in res.get_subtree()) < index:
+            self._indexes[path] = res.etcd_index + 1
 
     def __getattr__(self, attr):
         try:
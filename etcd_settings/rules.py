@@ -0,0 +1,96 @@
+import six
+
+
+class ConfigSetMatcher(object):
+    """
+    Selects config sets for a request out of a list of rules such as::
+
+        [
+            {"host": "tenant-a.example.com", "sets": ["tenant_a"]},
+            {"path": "/beta/", "sets": ["beta"]},
+            {"header": "X-Tenant", "value": "acme", "sets": ["acme"]}
+        ]
+
+    Every rule has exactly one criterion and a list of set names, anything
+    else raises ValueError. Hosts and headers are looked up in hash tables
+    and path prefixes in a trie, so a request is matched without going
+    through every rule. Sets are returned in rule order, later rules taking
+    precedence like later sets in the ``X-DYNAMIC-SETTING`` header.
+    """
+
+    CRITERIA = ('host', 'path', 'header')
+    # Headers Django does not prefix with HTTP_ in request.META
+    UNPREFIXED_HEADERS = ('CONTENT_TYPE', 'CONTENT_LENGTH')
+
+    def __init__(self, rules=()):
+        self._hosts = {}
+        self._headers = {}
+        self._paths = {}
+        if not isinstance(rules, (list, tuple)):
+            raise ValueError('Rules are not a list: {!r}'.format(rules))
+        for position, rule in enumerate(rules):
+            self._add_rule(position, rule)
+
+    def _add_rule(self, position, rule):
+        if not isinstance(rule, dict):
+            raise ValueError('Rule is not an object: {!r}'.format(rule))
+        sets = rule.get('sets')
+        if not isinstance(sets, list) or not all(
+                isinstance(s, six.string_types) for s in sets):
+            raise ValueError(
+                'Rule sets must be a list of names: {!r}'.format(rule))
+        criteria = [c for c in self.CRITERIA if c in rule]
+        if len(criteria) != 1:
+            raise ValueError(
+                'Rule must have exactly one of {}: {!r}'.format(
+                    ', '.join(self.CRITERIA), rule))
+        criterion = rule[criteria[0]]
+        if not isinstance(criterion, six.string_types) or not criterion:
+            raise ValueError('Rule {} must be a non-empty string: {!r}'.format(
+                criteria[0], rule))
+        if 'value' in rule:
+            if 'header' not in rule:
+                raise ValueError(
+                    'Only header rules can have a value: {!r}'.format(rule))
+            if not isinstance(rule['value'], six.string_types):
+                raise ValueError(
+                    'Rule value must be a string: {!r}'.format(rule))
+        match = (position, sets)
+        if 'host' in rule:
+            host = rule['host'].lower()
+            self._hosts.setdefault(host, []).append(match)
+        elif 'path' in rule:
+            node = self._paths
+            for c in rule['path']:
+                node = node.setdefault(c, {})
+            node.setdefault(None, []).append(match)
+        elif 'header' in rule:
+            key = rule['header'].upper().replace('-', '_')
+            if key not in self.UNPREFIXED_HEADERS:
+                key = 'HTTP_{}'.format(key)
+            values = self._headers.setdefault(key, {})
+            values.setdefault(rule.get('value'), []).append(match)
+
+    def __bool__(self):
+        return bool(self._hosts or self._headers or self._paths)
+
+    __nonzero__ = __bool__
+
+    def match(self, request):
+        matches = []
+        meta = getattr(request, 'META', None) or {}
+        host = meta.get('HTTP_HOST', meta.get('SERVER_NAME', ''))
+        matches.extend(
+            self._hosts.get(host.split(':', 1)[0].lower(), ()))
+        for key, values in self._headers.items():
+            if key in meta:
+                # A rule without value matches on the header being present
+                matches.extend(values.get(meta[key], ()))
+                matches.extend(values.get(None, ()))
+        node = self._paths
+        for c in getattr(request, 'path', ''):
+            node = node.get(c)
+            if node is None:
+                break
+            matches.extend(node.get(None, ()))
+        return [s for _, sets in sorted(matches) for s in sets]
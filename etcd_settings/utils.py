@@ -1,5 +1,8 @@
 import copy
 import os
+import random
+import threading
+import time
 from collections import Mapping
 
 
@@ -33,3 +36,87 @@ def copy_if_mutable(value):
     if type(value) in (dict, list):
         return copy.deepcopy(value)
     return value
+
+
+class Backoff(object):
+    """
+    Exponential backoff with full jitter, so that a fleet of processes losing
+    etcd at the same time does not reconnect in lockstep.
+    """
+
+    def __init__(self, base=0.5, cap=60):
+        self.base = base
+        self.cap = cap
+        self.attempts = 0
+
+    def next_delay(self):
+        delay = min(self.cap, self.base * (2 ** self.attempts))
+        self.attempts += 1
+        return random.uniform(0, delay)
+
+    def reset(self):
+        self.attempts = 0
+
+
+class CircuitBreaker(object):
+    """
+    Stops talking to etcd once `failure_threshold` consecutive failures have
+    been recorded, for a random period between `reset_timeout` and twice
+    that, so that processes which tripped together do not recover together.
+    After that period the circuit is half-open: `allow_request` lets a single
+    caller through to probe etcd, and its outcome closes or re-opens the
+    circuit. Every other caller keeps waiting meanwhile.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30, poll_interval=1):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.poll_interval = poll_interval
+        self.failures = 0
+        self.opened_until = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        opened_until = self.opened_until
+        if opened_until is None:
+            return self.CLOSED
+        if opened_until > time.time():
+            return self.OPEN
+        return self.HALF_OPEN
+
+    def allow_request(self):
+        with self._lock:
+            state = self.state
+            if state == self.CLOSED:
+                return True
+            if state == self.HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def retry_after(self):
+        """Seconds to wait before calling `allow_request` again"""
+        opened_until = self.opened_until
+        if opened_until is None:
+            return 0
+        return max(self.poll_interval, opened_until - time.time())
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_until = None
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._probing or self.failures >= self.failure_threshold:
+                self.opened_until = time.time() + random.uniform(
+                    self.reset_timeout, 2 * self.reset_timeout)
+            self._probing = False
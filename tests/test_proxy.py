@@ -6,10 +6,14 @@ import sys
 from django.http import HttpRequest
 from django.test import TestCase
 from django.test.utils import override_settings
+from etcd import (
+    EtcdConnectionFailed, EtcdEventIndexCleared, EtcdException,
+    EtcdKeyNotFound, EtcdLeaderElectionInProgress, EtcdWatchTimedOut,
+)
 from etcd_config.loader import get_overwrites
 from etcd_config.manager import EtcdClusterState, EtcdConfigManager
 from etcd_settings.proxy import EtcdSettingsProxy
-from mock import MagicMock
+from mock import MagicMock, patch
 
 from .conftest import settings
 
@@ -75,6 +79,110 @@ class TestEtcdSettingsProxy(TestCase):
         p = EtcdSettingsProxy()
         self.assertIsNotNone(p)
 
+    def test_proxy_starts_when_etcd_is_down(self):
+        with patch('etcd.Client.read', side_effect=EtcdConnectionFailed()):
+            p = EtcdSettingsProxy()
+        self.assertTrue(p.degraded)
+        self.assertIsNone(p.snapshot_age)
+        self.assertEqual({}, p._indexes)
+        self.assertEqual('test', p.DJES_ENV)
+
+    def test_proxy_starts_when_etcd_is_unhealthy(self):
+        for error in (EtcdException('Bad response : 503'),
+                      EtcdLeaderElectionInProgress()):
+            with patch('etcd.Client.read', side_effect=error):
+                p = EtcdSettingsProxy()
+            self.assertTrue(p.degraded)
+            self.assertEqual({}, p._config_sets)
+            self.assertEqual('test', p.DJES_ENV)
+
+    @override_settings(DJES_RECONNECT_POLICY=dict(startup_timeout=2))
+    def test_proxy_bounds_startup_reads_and_takes_their_index(self):
+        env = MagicMock(etcd_index=9, leaves=[])
+        with patch('etcd.Client.read', side_effect=[
+                EtcdKeyNotFound(payload={'index': 7}), env,
+                EtcdKeyNotFound(payload={'index': 9})]) as read:
+            p = EtcdSettingsProxy()
+        self.assertEqual(
+            [2, 2, 2], [c[1]['timeout'] for c in read.call_args_list])
+        self.assertEqual({
+            p._store.config_sets_path: 8,
+            p._store.env_defaults_path: 10,
+            p._store.rules_path: 10,
+        }, p._indexes)
+        self.assertEqual({}, p._config_sets)
+        self.assertFalse(p.degraded)
+
+    def test_proxy_stays_degraded_until_every_path_synced(self):
+        with patch('etcd.Client.read', side_effect=EtcdConnectionFailed()):
+            p = EtcdSettingsProxy()
+        p._synced[p._store.env_defaults_path] = 100
+        self.assertTrue(p.degraded)
+        self.assertIsNone(p.snapshot_age)
+        p._synced[p._store.config_sets_path] = 200
+        p._synced[p._store.rules_path] = 300
+        self.assertFalse(p.degraded)
+        with patch('time.time', return_value=400):
+            self.assertEqual(300, p.snapshot_age)
+
+    def test_proxy_exposes_snapshot_age(self):
+        self.assertFalse(self.proxy.degraded)
+        self.assertGreaterEqual(self.proxy.snapshot_age, 0)
+
+    @override_settings(DJES_RECONNECT_POLICY=dict(
+        backoff_base=0, failure_threshold=2, reset_timeout=0))
+    def test_proxy_watch_backs_off_and_resyncs(self):
+        p = EtcdSettingsProxy()
+        path = p._store.env_defaults_path
+        p._indexes[path] = 42
+        store = p._store = MagicMock(paths=(path,))
+        store.watch.side_effect = [
+            EtcdConnectionFailed(), EtcdConnectionFailed(),
+            EtcdWatchTimedOut(), EtcdEventIndexCleared()]
+        store.read.return_value = MagicMock(etcd_index=50)
+        store.read.return_value.get_subtree.return_value = [
+            MagicMock(modifiedIndex=40)]
+        with patch('time.sleep') as sleep:
+            events = list(p._watch(path, max_events=5))
+        self.assertEqual(
+            [None, None, None, None, store.read.return_value], events)
+        self.assertEqual(
+            [42, 42, 42, 51],
+            [c[0][1] for c in store.watch.call_args_list])
+        self.assertEqual(51, p._indexes[path])
+        self.assertEqual(2, sleep.call_count)
+        self.assertFalse(p.degraded)
+
+    def test_proxy_watch_timeout_keeps_index_on_changes(self):
+        p = EtcdSettingsProxy()
+        path = p._store.env_defaults_path
+        p._indexes[path] = 42
+        store = p._store = MagicMock(paths=(path,))
+        store.watch.side_effect = EtcdWatchTimedOut()
+        store.read.return_value = MagicMock(etcd_index=50)
+        store.read.return_value.get_subtree.return_value = [
+            MagicMock(modifiedIndex=40), MagicMock(modifiedIndex=45)]
+        self.assertEqual([None], list(p._watch(path, max_events=1)))
+        self.assertEqual(42, p._indexes[path])
+
+    def test_proxy_watch_timeout_needs_a_responsive_etcd(self):
+        p = EtcdSettingsProxy()
+        path = p._store.env_defaults_path
+        p._indexes[path] = 42
+        p._synced[path] = 100
+        store = p._store = MagicMock(paths=(path,))
+        store.watch.side_effect = EtcdWatchTimedOut()
+        store.read.side_effect = EtcdConnectionFailed()
+        p._breaker.failures = p._breaker.failure_threshold - 1
+        with patch('time.sleep') as sleep:
+            self.assertEqual([None], list(p._watch(path, max_events=1)))
+        self.assertEqual(
+            p._startup_timeout, store.read.call_args[1]['timeout'])
+        self.assertEqual(1, sleep.call_count)
+        self.assertEqual(42, p._indexes[path])
+        self.assertEqual(100, p._synced[path])
+        self.assertTrue(p.degraded)
+
     def test_proxy_reads_initial_blob(self):
         self.assertEquals(1, self.proxy.A)
         self.assertEquals("c", self.proxy.B)
@@ -108,6 +216,45 @@ class TestEtcdSettingsProxy(TestCase):
         self.assertEqual(1, c.get('c2'))
         self.assertEqual(2, c.get('c3'))
 
+    def test_proxy_selects_config_sets_by_rules(self):
+        rules_path = '{}/selection/rules'.format(settings.ETCD_PREFIX)
+        self.mgr._client.write(
+            rules_path,
+            json.dumps([
+                {'host': 'foo.example.com', 'sets': ['foo']},
+                {'path': '/bar/', 'sets': ['bar']}]))
+        self.addCleanup(self.mgr._client.delete, rules_path)
+        p = EtcdSettingsProxy()
+        r = HttpRequest()
+        r.path = '/bar/baz'
+        r.META = {'HTTP_HOST': 'foo.example.com'}
+        p._req_getter = MagicMock(return_value=r)
+        self.assertEqual(11, p.A)
+        self.assertEqual(2, p.C.get('c3'))
+
+    def test_proxy_header_sets_override_rules(self):
+        self.proxy._update_rules(MagicMock(
+            value=json.dumps([{'path': '/', 'sets': ['foo']}])))
+        self.mgr.set_config_sets({'baz': {'A': 12}})
+        self.addCleanup(
+            self.mgr._client.delete, self.mgr._config_set_path('baz'),
+            recursive=True)
+        self.proxy._config_sets = self.mgr.get_config_sets()
+        r = HttpRequest()
+        r.path = '/'
+        r.META = {'HTTP_X_DYNAMIC_SETTING': 'baz'}
+        self.proxy._req_getter = MagicMock(return_value=r)
+        self.assertEqual(12, self.proxy.A)
+        self.assertEqual(
+            ['foo', 'baz'], r._etcd_settings_config_sets[1])
+
+    def test_proxy_keeps_rules_when_invalid(self):
+        self.proxy._update_rules(MagicMock(
+            value=json.dumps([{'path': '/', 'sets': ['foo']}])))
+        rules = self.proxy._rules
+        self.proxy._update_rules(MagicMock(value=json.dumps([{'path': '/'}])))
+        self.assertIs(rules, self.proxy._rules)
+
     def test_proxy_locates_uwsgi_file(self):
         self.proxy._locate_wsgi_file(None)
         self.assertEqual(None, self.proxy._wsgi_file)
@@ -0,0 +1,92 @@
+import unittest
+
+from django.http import HttpRequest
+from etcd_settings.rules import ConfigSetMatcher
+
+
+class TestConfigSetMatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.matcher = ConfigSetMatcher([
+            {'host': 'Tenant-A.example.com', 'sets': ['tenant_a']},
+            {'path': '/api/', 'sets': ['api']},
+            {'path': '/api/v2/', 'sets': ['v2', 'beta']},
+            {'header': 'X-Tenant', 'value': 'acme', 'sets': ['acme']},
+            {'header': 'X-Canary', 'sets': ['canary']},
+            {'header': 'Content-Type', 'value': 'text/csv', 'sets': ['csv']},
+        ])
+
+    def _request(self, path='/', **meta):
+        r = HttpRequest()
+        r.path = path
+        r.META = meta
+        return r
+
+    def test_empty_matcher(self):
+        self.assertFalse(ConfigSetMatcher())
+        self.assertTrue(self.matcher)
+        self.assertEqual([], ConfigSetMatcher().match(self._request()))
+
+    def test_no_match(self):
+        self.assertEqual([], self.matcher.match(
+            self._request('/other/', HTTP_HOST='example.com')))
+
+    def test_host_match_ignores_port_and_case(self):
+        self.assertEqual(['tenant_a'], self.matcher.match(
+            self._request(HTTP_HOST='tenant-a.EXAMPLE.com:8000')))
+        self.assertEqual(['tenant_a'], self.matcher.match(
+            self._request(SERVER_NAME='tenant-a.example.com')))
+
+    def test_path_prefixes_match_in_rule_order(self):
+        self.assertEqual(['api'], self.matcher.match(self._request('/api/v1')))
+        self.assertEqual(
+            ['api', 'v2', 'beta'],
+            self.matcher.match(self._request('/api/v2/items')))
+        self.assertEqual([], self.matcher.match(self._request('/ap')))
+
+    def test_header_match(self):
+        self.assertEqual(['acme'], self.matcher.match(
+            self._request(HTTP_X_TENANT='acme')))
+        self.assertEqual([], self.matcher.match(
+            self._request(HTTP_X_TENANT='other')))
+        self.assertEqual(['canary'], self.matcher.match(
+            self._request(HTTP_X_CANARY='')))
+        self.assertEqual(['csv'], self.matcher.match(
+            self._request(CONTENT_TYPE='text/csv')))
+
+    def test_all_criteria_combined(self):
+        self.assertEqual(
+            ['tenant_a', 'api', 'acme'],
+            self.matcher.match(self._request(
+                '/api/', HTTP_X_TENANT='acme',
+                HTTP_HOST='tenant-a.example.com')))
+
+    def test_invalid_rules(self):
+        with self.assertRaises(ValueError):
+            ConfigSetMatcher([{'host': 'example.com'}])
+        with self.assertRaises(ValueError):
+            ConfigSetMatcher([{'sets': ['foo']}])
+        with self.assertRaises(ValueError):
+            ConfigSetMatcher([{'host': 'a.com', 'sets': 'tenant_a'}])
+        with self.assertRaises(ValueError):
+            ConfigSetMatcher([{'host': 'a.com', 'sets': [1]}])
+        with self.assertRaises(ValueError):
+            ConfigSetMatcher([
+                {'host': 'a.com', 'path': '/beta/', 'sets': ['beta']}])
+        with self.assertRaises(ValueError):
+            ConfigSetMatcher([{'path': 1, 'sets': ['beta']}])
+        with self.assertRaises(ValueError):
+            ConfigSetMatcher(['not a rule'])
+        with self.assertRaises(ValueError):
+            ConfigSetMatcher(5)
+        with self.assertRaises(ValueError):
+            ConfigSetMatcher([{'path': '', 'sets': ['beta']}])
+        with self.assertRaises(ValueError):
+            ConfigSetMatcher([{'header': 'X-T', 'value': 5, 'sets': ['t']}])
+        with self.assertRaises(ValueError):
+            ConfigSetMatcher(
+                [{'header': 'X-T', 'value': ['a'], 'sets': ['t']}])
+        with self.assertRaises(ValueError):
+            ConfigSetMatcher([{'host': 'a.com', 'value': 'a', 'sets': ['a']}])
+        with self.assertRaises(ValueError):
+            ConfigSetMatcher([{'path': '/a/', 'value': 'a', 'sets': ['a']}])
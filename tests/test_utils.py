@@ -2,6 +2,8 @@ import logging
 import unittest
 
 from etcd_config import utils
+from etcd_settings.utils import Backoff, CircuitBreaker
+from mock import patch
 
 
 class TestLoggingFilter(unittest.TestCase):
@@ -38,3 +40,81 @@ class TestLoggingFilter(unittest.TestCase):
                 )
             )
         )
+
+
+class TestBackoff(unittest.TestCase):
+
+    def test_delay_grows_exponentially_up_to_cap(self):
+        backoff = Backoff(base=1, cap=5)
+        with patch('random.uniform', side_effect=lambda a, b: b):
+            delays = [backoff.next_delay() for _ in range(5)]
+        self.assertEqual([1, 2, 4, 5, 5], delays)
+
+    def test_delay_is_jittered(self):
+        backoff = Backoff(base=1, cap=5)
+        with patch('random.uniform', return_value=0.3) as uniform:
+            self.assertEqual(0.3, backoff.next_delay())
+        uniform.assert_called_once_with(0, 1)
+
+    def test_reset(self):
+        backoff = Backoff(base=1, cap=5)
+        backoff.next_delay()
+        backoff.next_delay()
+        backoff.reset()
+        self.assertEqual(0, backoff.attempts)
+
+
+class TestCircuitBreaker(unittest.TestCase):
+
+    def setUp(self):
+        self.breaker = CircuitBreaker(failure_threshold=2, reset_timeout=10)
+
+    def _trip(self, now=100, jitter=5):
+        with patch('time.time', return_value=now), \
+                patch('random.uniform', return_value=10 + jitter):
+            self.breaker.record_failure()
+            self.breaker.record_failure()
+
+    def test_opens_after_threshold(self):
+        self.breaker.record_failure()
+        self.assertEqual(CircuitBreaker.CLOSED, self.breaker.state)
+        self.assertTrue(self.breaker.allow_request())
+        self.assertEqual(0, self.breaker.retry_after())
+        self.breaker.record_failure()
+        self.assertEqual(CircuitBreaker.OPEN, self.breaker.state)
+        self.assertFalse(self.breaker.allow_request())
+        self.assertGreater(self.breaker.retry_after(), 0)
+
+    def test_reset_timeout_is_jittered(self):
+        with patch('random.uniform', return_value=13) as uniform:
+            self.breaker.record_failure()
+            self.breaker.record_failure()
+        uniform.assert_called_once_with(10, 20)
+        with patch('time.time', return_value=self.breaker.opened_until - 13):
+            self.assertEqual(13, self.breaker.retry_after())
+
+    def test_half_open_lets_a_single_probe_through(self):
+        self._trip()
+        with patch('time.time', return_value=116):
+            self.assertEqual(CircuitBreaker.HALF_OPEN, self.breaker.state)
+            self.assertTrue(self.breaker.allow_request())
+            self.assertFalse(self.breaker.allow_request())
+            self.assertEqual(1, self.breaker.retry_after())
+
+    def test_failed_probe_reopens(self):
+        self._trip()
+        with patch('time.time', return_value=116):
+            self.assertTrue(self.breaker.allow_request())
+            self.breaker.record_failure()
+            self.assertEqual(CircuitBreaker.OPEN, self.breaker.state)
+            self.assertFalse(self.breaker.allow_request())
+
+    def test_success_closes(self):
+        self._trip()
+        with patch('time.time', return_value=116):
+            self.assertTrue(self.breaker.allow_request())
+        self.breaker.record_success()
+        self.assertEqual(CircuitBreaker.CLOSED, self.breaker.state)
+        self.assertEqual(0, self.breaker.failures)
+        self.assertTrue(self.breaker.allow_request())
+        self.assertTrue(self.breaker.allow_request())